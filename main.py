@@ -5,99 +5,142 @@ Replace album file photo copies with a metadata yaml file referencing the origin
 """
 
 from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import operator
+import os
 import pathlib
 import click
 import re
+import shutil
 from typing import Optional
 
-import ruamel.yaml
-
 
 Album = namedtuple(
     "Album", ["photo_files", "other_files", "name", "is_source", "is_special"]
 )
 Takeout = namedtuple("Takeout", ["photos_source", "albums", "special", "root_path"])
 
-source_folder_regex = re.compile(r"^Photos from \d{4}$")
 untitled_folder_regex = re.compile(r"^Untitled(?:\(\d+\))?$")
+# strings that can be written as plain yaml scalars ...
+yaml_plain_regex = re.compile(r"[\w(][\w()+\-.,]*(?: +[\w()+\-.,]+)*")
+# ... unless they would be read back as bool, null, number or timestamp
+yaml_implicit_regex = re.compile(
+    r"(?i:y|n|yes|no|on|off|true|false|null)"
+    r"|[-+]?(?:[\d_]*\.?[\d_]*(?:[eE][-+]?\d+)?|\.inf|\.nan)"
+    r"|0x[\da-fA-F_]+|0o[0-7_]+|0b[01_]+|[\d_]+(?::[0-5]?\d)+(?:\.\d*)?"
+    r"|\d{4}-\d\d?-\d\d?"
+    r"(?:(?:[Tt]|[ \t]+)\d\d?:\d\d:\d\d(?:\.\d*)?(?:[ \t]*(?:Z|[-+]\d\d?(?::\d\d)?))?)?"
+)
 
 album_folder_name = "ALBUMS"
-special_folders = ["Bin", "Archive", "Failed Videos", album_folder_name]
+special_folders = frozenset(("Bin", "Archive", "Failed Videos", album_folder_name))
 metadata_file_name = "metadata.json"
+digest_block_size = 1024 * 1024
+
+
+def _is_source(name: str) -> bool:
+    """
+    Check for a source folder name "Photos from <year>" without running a regex.
+    """
+    return len(name) == 16 and name.startswith("Photos from ") and name[12:].isdecimal()
 
 
 class FileCluster:
     """Bundle the actual image file with meta data file(s)."""
 
+    __slots__ = ("paths", "_names")
+
     def __init__(
-        self, paths: list[pathlib.Path], gphotos_root_path: Optional[pathlib.Path]
+        self,
+        paths: list[pathlib.Path],
+        gphotos_root_path: Optional[pathlib.Path],
+        *,
+        already_relative: bool = False,
     ):
         # first entry is the "base" file (e.g. photo.JPG)
         # use paths relative to the gphotos root path
-        if gphotos_root_path is not None:
-            self.paths = [
-                p.relative_to(gphotos_root_path) if p.is_file() else p for p in paths
-            ]
-        else:
+        if already_relative or gphotos_root_path is None:
             self.paths = paths
+        else:
+            self.paths = [p.relative_to(gphotos_root_path) for p in paths]
+        # file names of the paths, looked up often
+        self._names = [p.name for p in self.paths]
 
     def __repr__(self):
-        return f"FileCluster({', '.join(p.name for p in self.paths)})"
+        return f"FileCluster({', '.join(self._names)})"
 
     def prefix_rename(self, prefix: str, task_ledger: list):
         """
         Rename all files in the cluster with the given prefix.
         """
-        updated = []
-        for path in self.paths:
-            new_name = f"{prefix}{path.name}"
-            new_path = path.parent / new_name
-            task_ledger.append(("rename", path, new_path))
-            updated.append(new_path)
+        updated = [
+            path.parent / f"{prefix}{name}"
+            for path, name in zip(self.paths, self._names)
+        ]
+        task_ledger.extend(
+            ("rename", path, new_path) for path, new_path in zip(self.paths, updated)
+        )
 
-        return FileCluster(paths=updated, gphotos_root_path=None)
+        return FileCluster(paths=updated, gphotos_root_path=None, already_relative=True)
 
 
 def cluster_files_entries(entries: list[pathlib.Path], gphotos_root_path: pathlib.Path):
     # entries are sorted.
     # some metadata files have the full filename photo.JPG as base, others just the stem.
-    current_cluster = None
+    # name of the current cluster base file. No need to check the stem as well,
+    # a name starting with the base name also starts with its stem.
+    cluster_name = None
     clusters = defaultdict(list)
 
     for entry in entries:
-        if (
-            current_cluster is None
-            or not entry.name.startswith(current_cluster.name)
-            or not entry.name.startswith(current_cluster.stem)
-        ):
-            current_cluster = entry
+        name = entry.name
+        if cluster_name is None or not name.startswith(cluster_name):
+            cluster_name = name
 
-        clusters[current_cluster.name].append(entry)
+        clusters[cluster_name].append(entry)
 
-    return {k: FileCluster(v, gphotos_root_path) for k, v in clusters.items()}
+    # entries are all files below the gphotos root path
+    return {
+        k: FileCluster(v, gphotos_root_path, already_relative=False)
+        for k, v in clusters.items()
+    }
 
 
-def index_folder(path: pathlib.Path, gphotos_root_path: pathlib.Path) -> Album:
+def index_folder(
+    path: pathlib.Path,
+    gphotos_root_path: pathlib.Path,
+    is_source: Optional[bool] = None,
+) -> Album:
 
-    entries = sorted(list(path.iterdir()))
+    # scandir entries cache the file type, no extra stat call per check
+    with os.scandir(path) as it:
+        # sort by name only, clustering works on the file names
+        entries = sorted(it, key=operator.attrgetter("name"))
 
-    is_source = source_folder_regex.match(path.name) is not None
+    if is_source is None:
+        is_source = _is_source(path.name)
     is_special = path.name in special_folders
 
     # assert no subfolders
-    if any(p.is_dir() for p in entries):
+    if any(e.is_dir() for e in entries):
         raise ValueError("Subfolders are not allowed in a album folder.")
-    if not all(p.is_file() for p in entries):
+    if not all(e.is_file() for e in entries):
         raise ValueError("All entries in the album folder must be files.")
 
     if is_source:
         # assert no metadata file
-        if any(p.name == metadata_file_name for p in entries):
+        if any(e.name == metadata_file_name for e in entries):
             raise ValueError("Metadata file is not allowed in a source folder.")
 
-    clusters = cluster_files_entries(entries, gphotos_root_path)
-    photo_files = {c: v for c, v in clusters.items() if c != metadata_file_name}
-    other_files = {c: v for c, v in clusters.items() if c == metadata_file_name}
+    clusters = cluster_files_entries(
+        [pathlib.Path(e.path) for e in entries], gphotos_root_path
+    )
+    # the metadata file is the only non-photo cluster
+    other_files = {}
+    if metadata_file_name in clusters:
+        other_files[metadata_file_name] = clusters.pop(metadata_file_name)
+    photo_files = clusters
 
     album = Album(
         photo_files=photo_files,
@@ -117,30 +160,28 @@ def open_gphotos_root_path(gphotos_root_path: pathlib.Path) -> Takeout:
         if not image_dir.is_dir():
             continue
 
-        # if matches the regex, it is a source folder
-        if source_folder_regex.match(image_dir.name):
+        # "Photos from <year>" is a source folder
+        is_source = _is_source(image_dir.name)
+        if is_source:
             print(f"Found source folder: {image_dir.name}")
         else:
             print(f"Found non-source folder: {image_dir.name}")
 
-        album = index_folder(image_dir, gphotos_root_path)
+        album = index_folder(image_dir, gphotos_root_path, is_source)
         # do not keep empty folders
         if not album.photo_files and not album.other_files:
             print(f"Empty folder: {image_dir.name}. Skipping.")
             continue
         albums[album.name] = album
 
-    folder_special = {k: album for k, album in albums.items() if album.is_special}
-    folder_source = {
-        k: album
-        for k, album in albums.items()
-        if album.is_source and not album.is_special
-    }
-    folder_album = {
-        k: album
-        for k, album in albums.items()
-        if not album.is_source and not album.is_special
-    }
+    folder_special, folder_source, folder_album = {}, {}, {}
+    for k, album in albums.items():
+        if album.is_special:
+            folder_special[k] = album
+        elif album.is_source:
+            folder_source[k] = album
+        else:
+            folder_album[k] = album
 
     if not folder_source:
         raise ValueError("Need at least one photo source folder.")
@@ -168,6 +209,23 @@ def merge_files_in_albums(albums: dict[str, Album]) -> set:
     return files
 
 
+def merge_duplicates_in_albums(albums: dict[str, Album]) -> tuple[dict, list]:
+    """
+    Like merge_files_in_albums, but also return the files found in multiple albums.
+    """
+    files = defaultdict(list)
+    duplicates = set()
+    for album in albums.values():
+        for file in album.photo_files:
+            album_names = files[file]
+            album_names.append(album.name)
+            if len(album_names) == 2:
+                duplicates.add(file)
+
+    # keep the order of first occurrence, the files are resolved in this order
+    return files, [file for file in files if file in duplicates]
+
+
 def get_album_files_to_replace(album: Album, merged_source_files):
     # exactly once in source files
     replaceable_files = set()
@@ -198,17 +256,15 @@ def get_album_files_to_replace(album: Album, merged_source_files):
     return replaceable_files, unique_files, unmatched_files
 
 
-def compare_two_files(
-    file1: pathlib.Path, file2: pathlib.Path, gphotos_root_path: pathlib.Path
-) -> bool:
+def file_digest(path: pathlib.Path) -> bytes:
     """
-    Compare two files and return True if they are the same.
+    Return the content hash of a file.
     """
-    # compare the contents of the files
-    with open(gphotos_root_path / file1, "rb") as f1, open(
-        gphotos_root_path / file2, "rb"
-    ) as f2:
-        return f1.read() == f2.read()
+    h = hashlib.blake2b()
+    with open(path, "rb") as f:
+        while chunk := f.read(digest_block_size):
+            h.update(chunk)
+    return h.digest()
 
 
 def _rename_cluster(
@@ -217,8 +273,7 @@ def _rename_cluster(
     duplicate_key,
     updated_key,
     task_ledger,
-    album_files,
-    source_files,
+    taken_names: set,
 ):
     """
     Rename the cluster with the given prefix.
@@ -227,13 +282,9 @@ def _rename_cluster(
     renamed_cluster = cluster.prefix_rename(prefix_str, task_ledger)
 
     # make sure that none of the renamed files exists globally in the source files or album files
-    if any(p.name in album_files for p in renamed_cluster.paths):
+    if any(name in taken_names for name in renamed_cluster._names):
         raise ValueError(
-            f"File {renamed_cluster.paths[0].name} already exists in album files."
-        )
-    if any(p.name in source_files for p in renamed_cluster.paths):
-        raise ValueError(
-            f"File {renamed_cluster.paths[0].name} already exists in source files."
+            f"File {renamed_cluster._names[0]} already exists in album or source files."
         )
 
     photo_files[updated_key] = renamed_cluster
@@ -241,7 +292,13 @@ def _rename_cluster(
 
 
 def resolve_album_duplicate(
-    takeout: Takeout, album_files, source_files, duplicate: str, task_ledger
+    takeout: Takeout,
+    album_files,
+    source_files,
+    duplicate: str,
+    task_ledger,
+    digests,
+    taken_names: set,
 ) -> dict:
     """ """
     album_files_to_match: dict = {
@@ -256,17 +313,22 @@ def resolve_album_duplicate(
     # sources key -> album list (if same file in multiple albums)
     matches = defaultdict(list)
 
+    # compare only the cluster base file. Don't care about other files.
+    # hash every file once and match by digest instead of comparing all pairs.
+    # files without a digest have no same-sized counterpart and cannot match.
+    sources_by_digest = defaultdict(list)
+    for ks, source_file in source_files_to_match.items():
+        digest = digests.get(source_file.paths[0])
+        if digest is not None:
+            sources_by_digest[digest].append(ks)
+
     for ka, album_file in album_files_to_match.items():
-        for ks, source_file in source_files_to_match.items():
-            # compare only the cluster base file. Don't care about other files.
-            if compare_two_files(
-                album_file.paths[0], source_file.paths[0], takeout.root_path
-            ):
-                matches[ks].append(ka)
+        for ks in sources_by_digest.get(digests.get(album_file.paths[0]), ()):
+            matches[ks].append(ka)
     # find unmatched source files
     unmatched_source = set(source_files_to_match.keys()) - set(matches.keys())
 
-    rename_args = (task_ledger, album_files, source_files)
+    rename_args = (task_ledger, taken_names)
 
     for match_source, match_albums in matches.items():
         prefix_str = match_source.replace(" ", "_") + "__"
@@ -303,50 +365,126 @@ def resolve_album_duplicate(
     # remove cluster from merged lists
     del album_files[duplicate]
     del source_files[duplicate]
+    taken_names.discard(duplicate)
+
+
+def hash_files(
+    paths: list[pathlib.Path],
+    gphotos_root_path: pathlib.Path,
+    max_workers: Optional[int] = None,
+) -> dict:
+    """
+    Hash the given files in parallel. Returns a dict path -> digest.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as ex:
+        digests = ex.map(file_digest, (gphotos_root_path / p for p in paths))
+        return dict(zip(paths, digests))
 
 
-def resolve_duplicates(takeout: Takeout, task_ledger):
+def resolve_duplicates(
+    takeout: Takeout, task_ledger, hash_workers: Optional[int] = None
+):
     """
     Resolve duplicates in the source files and album files.
     """
     album_files = merge_files_in_albums(takeout.albums)
-    source_files = merge_files_in_albums(takeout.photos_source)
+    source_files, source_duplicates = merge_duplicates_in_albums(takeout.photos_source)
+
+    # hash the base file of every cluster that may match up front
+    to_hash = set()
+    for duplicate in source_duplicates:
+        albums = album_files.get(duplicate)
+        if not albums:
+            # no album copy to match, the source copies are only renamed
+            continue
+        source_paths = [
+            takeout.photos_source[source].photo_files[duplicate].paths[0]
+            for source in source_files[duplicate]
+        ]
+        album_paths = [
+            takeout.albums[album].photo_files[duplicate].paths[0] for album in albums
+        ]
+        # files of different size cannot be equal, only hash same-sized candidates
+        sizes = {
+            p: os.stat(takeout.root_path / p).st_size
+            for p in source_paths + album_paths
+        }
+        source_sizes = {sizes[p] for p in source_paths}
+        album_sizes = {sizes[p] for p in album_paths}
+        to_hash.update(p for p in source_paths if sizes[p] in album_sizes)
+        to_hash.update(p for p in album_paths if sizes[p] in source_sizes)
+    digests = hash_files(list(to_hash), takeout.root_path, hash_workers)
 
-    source_duplicates = {k: v for k, v in source_files.items() if len(v) > 1}
-    for source_duplicate, sources in source_duplicates.items():
+    # file names in use by any album or source, kept in sync with the merged lists
+    taken_names = set(album_files)
+    taken_names.update(source_files)
+
+    for source_duplicate in source_duplicates:
         resolve_album_duplicate(
-            takeout, album_files, source_files, source_duplicate, task_ledger
+            takeout,
+            album_files,
+            source_files,
+            source_duplicate,
+            task_ledger,
+            digests,
+            taken_names,
         )
 
 
+def _yaml_quote(value: str) -> str:
+    """
+    Format a string as yaml scalar. Only quote if a plain scalar would be ambiguous.
+    """
+    if yaml_plain_regex.fullmatch(value) and not yaml_implicit_regex.fullmatch(value):
+        return value
+    if value.isprintable():
+        return "'" + value.replace("'", "''") + "'"
+    return '"' + "".join(map(_yaml_escape, value)) + '"'
+
+
+def _yaml_escape(char: str) -> str:
+    """
+    Escape a character for a double-quoted yaml scalar.
+    """
+    if char in '"\\':
+        return "\\" + char
+    if char.isprintable():
+        return char
+    code = ord(char)
+    if code < 0x100:
+        return f"\\x{code:02x}"
+    if code < 0x10000:
+        return f"\\u{code:04x}"
+    return f"\\U{code:08x}"
+
+
 def replace_album_files_with_yaml_metadata(takeout: Takeout, task_ledger):
     """
     Replace album files with yaml metadata.
     """
     for album in takeout.albums.values():
-        data = {
-            "album": album.name,
-            "photo_files": [
-                path.name  # unique files, do not include album name
-                for cluster in album.photo_files.values()
-                for path in cluster.paths
-            ],
-        }
-
-        yaml = ruamel.yaml.YAML()
-        stream = ruamel.yaml.StringIO()
-        yaml.dump(data, stream)
-        yaml_str = stream.getvalue()
+        # unique files, do not include album name
+        photo_files = [
+            name for cluster in album.photo_files.values() for name in cluster._names
+        ]
+        yaml_str = f"album: {_yaml_quote(album.name)}\n"
+        if photo_files:
+            yaml_str += "photo_files:\n" + "".join(
+                f"- {_yaml_quote(name)}\n" for name in photo_files
+            )
+        else:
+            yaml_str += "photo_files: []\n"
 
-        yaml_path = pathlib.Path(album.name) / "album.yaml"
+        album_path = pathlib.Path(album.name)
+        yaml_path = album_path / "album.yaml"
         task_ledger.append(("create", yaml_path, yaml_str))
-        task_ledger.extend(
-            [
-                ("delete", path)
-                for cluster in album.photo_files.values()
-                for path in cluster.paths
-            ]
+        # remove all photo files at once, keep the yaml and other files
+        keep = {yaml_path.name}
+        keep.update(
+            name for cluster in album.other_files.values() for name in cluster._names
         )
+        # sorted tuple, so the dry run output is stable
+        task_ledger.append(("delete_tree_except", album_path, tuple(sorted(keep))))
 
 
 def remove_untitled_albums(takeout: Takeout, task_ledger):
@@ -354,6 +492,9 @@ def remove_untitled_albums(takeout: Takeout, task_ledger):
     Remove albums without a title.
     """
     to_delete = []
+    all_source_keys = set().union(
+        *(source.photo_files.keys() for source in takeout.photos_source.values())
+    )
     for album in list(takeout.albums.values()):
         if untitled_folder_regex.fullmatch(album.name):
 
@@ -361,10 +502,7 @@ def remove_untitled_albums(takeout: Takeout, task_ledger):
             all_available = True
 
             for filecluster_key in album.photo_files:
-                for source in takeout.photos_source.values():
-                    if filecluster_key in source.photo_files:
-                        break
-                else:
+                if filecluster_key not in all_source_keys:
                     # file not found in any source folder
                     print(
                         f"File cluster {filecluster_key} not found in source folder. Not deleting untitled album {album.name}."
@@ -397,12 +535,14 @@ def move_into_album_folder(
             )
 
 
-def optimize_takeout(takeout: Takeout, keep_untitled_albums: bool):
+def optimize_takeout(
+    takeout: Takeout, keep_untitled_albums: bool, hash_workers: Optional[int] = None
+):
 
     task_ledger = []
 
     # take care of all duplicates in the source files
-    resolve_duplicates(takeout, task_ledger)
+    resolve_duplicates(takeout, task_ledger, hash_workers)
 
     # remove untitled albums
     if not keep_untitled_albums:
@@ -422,32 +562,42 @@ def execute_task_ledger(gphotos_root_path: pathlib.Path, task_ledger, dry_run: b
     Execute the tasks in the task ledger.
     """
 
+    # join plain strings, cheaper than building a pathlib.Path per task
+    root = str(gphotos_root_path)
+
     def delete(path: pathlib.Path):
-        path = gphotos_root_path / path
-        if path.is_dir():
-            for child in path.iterdir():
-                delete(child)
-            path.rmdir()
+        path = os.path.join(root, path)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
         else:
-            path.unlink()
+            os.unlink(path)
+
+    def delete_tree_except(path: pathlib.Path, keep: tuple[str, ...]):
+        path = os.path.join(root, path)
+        keep = set(keep)
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name not in keep:
+                    os.unlink(entry.path)
 
     def create(path: pathlib.Path, content: str):
-        path = gphotos_root_path / path
+        path = os.path.join(root, path)
         with open(path, "w") as f:
             f.write(content)
 
     def create_dir(path: pathlib.Path):
-        path = gphotos_root_path / path
-        path.mkdir(parents=True, exist_ok=True)
+        path = os.path.join(root, path)
+        os.makedirs(path, exist_ok=True)
 
     def rename(old_path: pathlib.Path, new_path: pathlib.Path):
-        old_path = gphotos_root_path / old_path
-        new_path = gphotos_root_path / new_path
+        old_path = os.path.join(root, old_path)
+        new_path = os.path.join(root, new_path)
         # this also works for non-empty directories
-        old_path.rename(new_path)
+        os.rename(old_path, new_path)
 
     actions = {
         "delete": delete,
+        "delete_tree_except": delete_tree_except,
         "create": create,
         "create_dir": create_dir,
         "rename": rename,
@@ -476,12 +626,18 @@ def execute_task_ledger(gphotos_root_path: pathlib.Path, task_ledger, dry_run: b
     default=False,
     help="Print actions without executing them",
 )
-def main(folder, keep_untitled_albums: bool, dry_run: bool):
+@click.option(
+    "--hash-workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of files hashed in parallel (default: CPU count, use 1-2 for HDDs)",
+)
+def main(folder, keep_untitled_albums: bool, dry_run: bool, hash_workers):
     """
     Analyze the contents of the specified folder and print the counts of each file type.
     """
     takeout = open_gphotos_root_path(folder)
-    task_ledger = optimize_takeout(takeout, keep_untitled_albums)
+    task_ledger = optimize_takeout(takeout, keep_untitled_albums, hash_workers)
     execute_task_ledger(takeout.root_path, task_ledger, dry_run=dry_run)
 
 
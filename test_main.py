@@ -0,0 +1,198 @@
+import pathlib
+
+import pytest
+
+import main
+
+yaml = pytest.importorskip("ruamel.yaml")
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        # timestamps
+        "2020-01-01",
+        "2021-5-5",
+        "2020-01-01 10:00:00",
+        "2020-01-01T10:00:00Z",
+        # bool and null
+        "true",
+        "False",
+        "yes",
+        "no",
+        "on",
+        "y",
+        "null",
+        "~",
+        "",
+        # numbers
+        "2020",
+        "1_000",
+        "1e5",
+        "1E5",
+        "-1.5",
+        ".inf",
+        ".nan",
+        "0x1F",
+        "0o17",
+        "12:30",
+        # indicator characters
+        "-x",
+        "- x",
+        "? x",
+        ": x",
+        "a: b",
+        "a #b",
+        "#a",
+        "[x]",
+        "{x}",
+        "*x",
+        "&x",
+        "!x",
+        "|x",
+        ">x",
+        "%x",
+        "@x",
+        "`x",
+        "'q'",
+        '"q"',
+        " x",
+        "x ",
+        "x\n",
+        "x\ty",
+        "Trip\t😀",
+        "😀\x85",
+        "party 🎉\u2028",
+        'a\\b\x00"',
+        # plain names
+        "IMG_1234.JPG",
+        "Trip: Rome",
+        "Untitled(2)",
+        "Photos from 2020",
+        "été.jpg",
+    ],
+)
+def test_yaml_quote_round_trip(name):
+    doc = f"album: {main._yaml_quote(name)}\nphoto_files:\n- {main._yaml_quote(name)}\n"
+    assert yaml.YAML(typ="safe").load(doc) == {"album": name, "photo_files": [name]}
+
+
+def test_yaml_quote_keeps_plain_names_unquoted():
+    assert main._yaml_quote("IMG_1234.JPG") == "IMG_1234.JPG"
+    assert main._yaml_quote("Untitled(2)") == "Untitled(2)"
+
+
+def test_yaml_quote_quotes_timestamps():
+    assert main._yaml_quote("2020-01-01") == "'2020-01-01'"
+
+
+def test_yaml_quote_keeps_printable_characters_in_double_quotes():
+    assert main._yaml_quote("Trip\t😀") == '"Trip\\x09😀"'
+
+
+def index_folders(root, folders):
+    """
+    Create {folder name: {file name: content}} on disk and index it in order.
+    """
+    albums = {}
+    for name, files in folders.items():
+        (root / name).mkdir()
+        for file, content in files.items():
+            (root / name / file).write_bytes(content)
+        albums[name] = main.index_folder(root / name, root)
+    return albums
+
+
+def make_takeout(root, sources, albums):
+    return main.Takeout(
+        photos_source=index_folders(root, sources),
+        albums=index_folders(root, albums),
+        special={},
+        root_path=root,
+    )
+
+
+def test_resolve_duplicates_hashes_only_candidates(tmp_path, monkeypatch):
+    takeout = make_takeout(
+        tmp_path,
+        sources={
+            "Photos from 2020": {"a.jpg": b"a", "b.jpg": b"b", "c.jpg": b"c"},
+            "Photos from 2021": {"a.jpg": b"aa", "b.jpg": b"bb", "c.jpg": b"cc"},
+        },
+        albums={"Trip": {"a.jpg": b"a", "b.jpg": b"bbb"}},
+    )
+    hashed = []
+    file_digest = main.file_digest
+    monkeypatch.setattr(
+        main, "file_digest", lambda p: hashed.append(p) or file_digest(p)
+    )
+
+    task_ledger = []
+    main.resolve_duplicates(takeout, task_ledger, hash_workers=1)
+
+    # c.jpg is in no album, the album b.jpg matches no source size
+    assert sorted(hashed) == [
+        tmp_path / "Photos from 2020" / "a.jpg",
+        tmp_path / "Trip" / "a.jpg",
+    ]
+    assert list(takeout.albums["Trip"].photo_files) == [
+        "b.jpg",
+        "Photos_from_2020__a.jpg",
+    ]
+
+
+def test_merge_duplicates_in_albums_keeps_first_seen_order(tmp_path):
+    sources = index_folders(
+        tmp_path,
+        {
+            "Photos from 2020": {"b.jpg": b"1"},
+            "Photos from 2021": {"a.jpg": b"2"},
+            "Photos from 2022": {"a.jpg": b"3", "b.jpg": b"4"},
+        },
+    )
+
+    files, duplicates = main.merge_duplicates_in_albums(sources)
+
+    # b.jpg is seen first, although a.jpg is seen a second time first
+    assert duplicates == ["b.jpg", "a.jpg"]
+    assert files["a.jpg"] == ["Photos from 2021", "Photos from 2022"]
+
+
+def test_resolve_duplicates_renames_in_first_seen_order(tmp_path):
+    takeout = make_takeout(
+        tmp_path,
+        sources={
+            "Photos from 2020": {"b.jpg": b"1"},
+            "Photos from 2021": {"a.jpg": b"2"},
+            "Photos from 2022": {"a.jpg": b"3", "b.jpg": b"4"},
+        },
+        albums={"Trip": {"a.jpg": b"3", "b.jpg": b"1"}},
+    )
+
+    task_ledger = []
+    main.resolve_duplicates(takeout, task_ledger, hash_workers=1)
+
+    renamed = [task[1].name for task in task_ledger if task[0] == "rename"]
+    assert renamed[0] == "b.jpg"
+    assert renamed.index("b.jpg") < renamed.index("a.jpg")
+    assert list(takeout.albums["Trip"].photo_files) == [
+        "Photos_from_2020__b.jpg",
+        "Photos_from_2022__a.jpg",
+    ]
+
+
+def test_replace_album_files_keeps_sorted_names(tmp_path):
+    takeout = make_takeout(
+        tmp_path,
+        sources={"Photos from 2020": {"a.jpg": b"a"}},
+        albums={"Trip": {"a.jpg": b"a", "metadata.json": b"{}"}},
+    )
+
+    task_ledger = []
+    main.replace_album_files_with_yaml_metadata(takeout, task_ledger)
+
+    assert task_ledger[-1] == (
+        "delete_tree_except",
+        pathlib.Path("Trip"),
+        ("album.yaml", "metadata.json"),
+    )